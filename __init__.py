@@ -1,4 +1,14 @@
 # -*- coding: utf-8 -*-
 
-from .core import File, Directory, FileTree
-from .gui import MainMenu
+from .core import File, Directory, FileTree, compare_directories
+from .scheduler import HashScheduler
+from .chunking import ChunkIndex, chunk_file, find_partial_duplicates
+from .snapshots import SnapshotStore
+
+def __getattr__(name):
+    #Tk is only imported when a GUI class is requested, so the package and
+    #the CLI can be used on machines without a display.
+    if name in ('Master', 'ScanResult', 'DuplicateSummary', 'UsageReport'):
+        from . import gui
+        return getattr(gui, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
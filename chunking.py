@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+Content-defined chunking and partial-duplicate analysis.
+
+Files are split at content-defined boundaries chosen by a gear rolling hash,
+so that inserting or appending data only disturbs the chunks around the edit.
+Chunk digests are stored in a compact index which can then report pairs of
+files sharing content, and estimate the savings of block-level deduplication.
+"""
+
+import os, sys, hashlib, random
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+#Gear table for the rolling hash. Seeded so chunk boundaries are stable
+#between runs and between worker processes.
+_rng = random.Random(0x6d656469)
+_GEAR = tuple(_rng.getrandbits(64) for _ in range(256))
+del _rng
+_MASK64 = 2**64 - 1
+DIGEST_SIZE = 16
+
+def chunk_file(filename, avg_size=2**16, min_size=None, max_size=None,
+               buffersize=2**20):
+    '''
+    Splits a file into content-defined chunks. The file is streamed in blocks
+    of buffersize bytes, so memory use does not depend on file size.
+
+    Parameters
+    ----------
+    filename : str
+        Path of file to be chunked.
+    avg_size : int, optional
+        Target average chunk size, in bytes. Must be a power of two.
+        The default is 2**16.
+    min_size : int, optional
+        Minimum chunk size, in bytes. Must be positive and less than max_size.
+        The default is avg_size // 4.
+    max_size : int, optional
+        Maximum chunk size, in bytes. The default is avg_size * 4.
+    buffersize : int, optional
+        Size of read buffer, in bytes. The default is 2**20.
+
+    Returns
+    -------
+    lengths : array
+        Length of each chunk, in bytes.
+    digests : bytes
+        Concatenated BLAKE2b digests of each chunk, DIGEST_SIZE bytes apiece.
+    '''
+    if avg_size < 1 or avg_size & (avg_size - 1):
+        raise ValueError(f'Average chunk size must be a power of two, got {avg_size}')
+    if min_size is None: min_size = avg_size // 4
+    if max_size is None: max_size = avg_size * 4
+    if not 0 < min_size < max_size:
+        raise ValueError(f'Chunk sizes must satisfy 0 < min_size < max_size, got {min_size} and {max_size}')
+    mask = avg_size - 1
+    gear = _GEAR
+    M = _MASK64
+
+    lengths = array('I')
+    digests = bytearray()
+    hasher = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    length = 0          #Bytes in current chunk so far
+    h = 0
+
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(buffersize)
+            if not block:
+                break
+            view = memoryview(block)
+            n = len(block)
+            start = 0       #Start of current chunk within this block
+            i = 0
+            while i < n:
+                #Boundaries are never placed inside the first min_size bytes
+                #of a chunk, so skip them without hashing.
+                if length < min_size:
+                    skip = min(min_size - length, n - i)
+                    i += skip
+                    length += skip
+                    continue
+                limit = min(n, i + max_size - length)
+                j = i
+                while j < limit:
+                    h = ((h << 1) + gear[block[j]]) & M
+                    j += 1
+                    if not h & mask:
+                        break
+                length += j - i
+                i = j
+                if not h & mask or length >= max_size:
+                    hasher.update(view[start:i])
+                    lengths.append(length)
+                    digests += hasher.digest()
+                    hasher = hashlib.blake2b(digest_size=DIGEST_SIZE)
+                    start = i
+                    length = 0
+                    h = 0
+            hasher.update(view[start:])
+
+    if length > 0:
+        lengths.append(length)
+        digests += hasher.digest()
+    return lengths, bytes(digests)
+
+def _chunk_worker(args):
+    filename, kwargs = args
+    try:
+        return chunk_file(filename, **kwargs)
+    except OSError:
+        print(f'WARNING:File {filename} could not be chunked!', file=sys.stderr)
+        return None
+
+class ChunkIndex:
+    '''
+    Compact index of chunk digests. Each distinct digest is assigned an
+    integer id, and every file is stored as an array of chunk ids, so the
+    per-chunk cost is a few bytes plus one digest per distinct chunk.
+    '''
+
+    def __init__(self):
+        self.files = []             #Indexed objects, in insertion order
+        self.file_sizes = array('Q')
+        self.file_chunks = []       #array('I') of chunk ids per file
+        self.chunk_ids = {}         #digest -> chunk id
+        self.chunk_sizes = array('I')
+        return
+
+    def __len__(self):
+        return len(self.files)
+
+    def add(self, file, lengths, digests):
+        '''
+        Adds the chunks of a file to the index.
+
+        Parameters
+        ----------
+        file : object
+            Object identifying the file, returned in reports.
+        lengths : array
+            Chunk lengths, as returned by chunk_file.
+        digests : bytes
+            Concatenated chunk digests, as returned by chunk_file.
+
+        Returns
+        -------
+        None.
+
+        '''
+        ids = array('I')
+        for k, length in enumerate(lengths):
+            digest = digests[k*DIGEST_SIZE:(k+1)*DIGEST_SIZE]
+            cid = self.chunk_ids.get(digest)
+            if cid is None:
+                cid = len(self.chunk_sizes)
+                self.chunk_ids[digest] = cid
+                self.chunk_sizes.append(length)
+            ids.append(cid)
+        self.files.append(file)
+        self.file_sizes.append(sum(lengths))
+        self.file_chunks.append(ids)
+        return
+
+    @property
+    def total_bytes(self):
+        return sum(self.file_sizes)
+
+    @property
+    def unique_bytes(self):
+        return sum(self.chunk_sizes)
+
+    def dedup_savings(self):
+        '''
+        Estimates the space saved by block-level deduplication of every
+        indexed file.
+
+        Returns
+        -------
+        savings : int
+            Number of bytes which would not need to be stored.
+        '''
+        return self.total_bytes - self.unique_bytes
+
+    def shared_pairs(self, min_ratio=0.5, max_fanout=64):
+        '''
+        Finds pairs of files which share chunks.
+
+        Parameters
+        ----------
+        min_ratio : float, optional
+            Minimum shared-byte ratio for a pair to be reported. The ratio is
+            the number of shared bytes divided by the size of the smaller
+            file, so a file appended to another scores 1.0. The default is 0.5.
+        max_fanout : int, optional
+            Chunks found in more than this many files (e.g. runs of zeros,
+            or a file with many copies) are not paired, to avoid quadratic
+            blowup; they are reported by shared_groups instead. The default
+            is 64.
+
+        Returns
+        -------
+        pairs : list
+            List of (file_a, file_b, shared_bytes, ratio) tuples, sorted by
+            descending ratio.
+        '''
+        shared = {}
+        for cid, fids in self._owners().items():
+            if len(fids) < 2 or len(fids) > max_fanout:
+                continue
+            size = self.chunk_sizes[cid]
+            for a in range(len(fids)):
+                for b in range(a + 1, len(fids)):
+                    key = (fids[a], fids[b])
+                    shared[key] = shared.get(key, 0) + size
+
+        pairs = []
+        for (a, b), nbytes in shared.items():
+            smaller = min(self.file_sizes[a], self.file_sizes[b])
+            ratio = nbytes / smaller if smaller else 0.0
+            if ratio >= min_ratio:
+                pairs.append((self.files[a], self.files[b], nbytes, ratio))
+        pairs.sort(key=lambda pair: (pair[3], pair[2]), reverse=True)
+        return pairs
+
+    def shared_groups(self, min_ratio=0.5, max_fanout=64):
+        '''
+        Finds groups of files sharing chunks too widely spread to pair, i.e.
+        found in more than max_fanout files. Chunks with the same set of
+        owning files are summed, so each group costs one entry however many
+        files it holds.
+
+        Parameters
+        ----------
+        min_ratio : float, optional
+            Minimum shared-byte ratio for a group to be reported, relative
+            to the smallest file in the group. The default is 0.5.
+        max_fanout : int, optional
+            Fanout above which chunks are grouped rather than paired, see
+            shared_pairs. The default is 64.
+
+        Returns
+        -------
+        groups : list
+            List of (files, shared_bytes, ratio) tuples, sorted by
+            descending ratio.
+        '''
+        shared = {}
+        for cid, fids in self._owners().items():
+            if len(fids) > max_fanout:
+                key = tuple(fids)
+                shared[key] = shared.get(key, 0) + self.chunk_sizes[cid]
+
+        groups = []
+        for fids, nbytes in shared.items():
+            smaller = min(self.file_sizes[fid] for fid in fids)
+            ratio = nbytes / smaller if smaller else 0.0
+            if ratio >= min_ratio:
+                groups.append(([self.files[fid] for fid in fids], nbytes, ratio))
+        groups.sort(key=lambda group: (group[2], group[1]), reverse=True)
+        return groups
+
+    def _owners(self):
+        #Invert index: chunk id -> ids of files containing it, in file order
+        owners = {}
+        for fid, ids in enumerate(self.file_chunks):
+            for cid in set(ids):
+                owners.setdefault(cid, []).append(fid)
+        return owners
+
+def build_chunk_index(files, workers=None, avg_size=2**16, buffersize=2**20):
+    '''
+    Chunks files in parallel and collects the results in a ChunkIndex.
+
+    Parameters
+    ----------
+    files : iterable
+        File objects (or anything with a long_name attribute) to be indexed.
+    workers : int, optional
+        Number of worker processes. The default is os.cpu_count().
+    avg_size : int, optional
+        Target average chunk size, in bytes. The default is 2**16.
+    buffersize : int, optional
+        Size of read buffer, in bytes. The default is 2**20.
+
+    Returns
+    -------
+    index : ChunkIndex
+        Index of chunks from every file which could be read.
+    '''
+    files = list(files)
+    kwargs = {'avg_size':avg_size, 'buffersize':buffersize}
+    jobs = [(file.long_name, kwargs) for file in files]
+    index = ChunkIndex()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(_chunk_worker, jobs, chunksize=8)
+        for file, result in zip(files, results):
+            if result is not None:
+                index.add(file, *result)
+    return index
+
+def find_partial_duplicates(files, min_ratio=0.5, workers=None, avg_size=2**16,
+                            max_fanout=64):
+    '''
+    Searches for files sharing content, using content-defined chunking.
+
+    Parameters
+    ----------
+    files : iterable
+        File objects to be compared.
+    min_ratio : float, optional
+        Minimum shared-byte ratio for a pair to be reported, see
+        ChunkIndex.shared_pairs. The default is 0.5.
+    workers : int, optional
+        Number of worker processes. The default is os.cpu_count().
+    avg_size : int, optional
+        Target average chunk size, in bytes. The default is 2**16.
+    max_fanout : int, optional
+        Chunks shared by more files than this are reported as groups rather
+        than pairs, see ChunkIndex.shared_pairs. The default is 64.
+
+    Returns
+    -------
+    report : dict
+        Dictionary containing the matching pairs, groups of widely shared
+        content, total bytes scanned, bytes remaining after block-level
+        deduplication and estimated savings.
+    '''
+    index = build_chunk_index(files, workers=workers, avg_size=avg_size)
+    report = {
+        'pairs':index.shared_pairs(min_ratio, max_fanout),
+        'groups':index.shared_groups(min_ratio, max_fanout),
+        'total_bytes':index.total_bytes,
+        'unique_bytes':index.unique_bytes,
+        'savings':index.dedup_savings()
+        }
+    return report
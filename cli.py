@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+Headless command-line interface.
+
+Every command writes newline-delimited JSON to stdout, one record per line,
+as results become available. Diagnostics printed by the library are sent to
+stderr so they cannot corrupt the stream. Run with
+`python -m mediamanager --help`.
+"""
+
+import os, sys, json, argparse, hashlib, contextlib
+from .core import FileTree, compare_directories
+from .scheduler import HashScheduler
+
+#shake_* digests need a length argument, so they are not offered
+ALGORITHMS = sorted(a for a in hashlib.algorithms_guaranteed if not a.startswith('shake'))
+
+#Stream for NDJSON records; set by main while sys.stdout points at stderr
+_output = sys.stdout
+
+def emit(record):
+    _output.write(json.dumps(record) + '\n')
+    _output.flush()
+    return
+
+def file_record(event, file):
+    record = {'event':event}
+    record.update(file.decompose())
+    return record
+
+def make_scheduler(args):
+    device_workers = {}
+    for override in args.device_workers:
+        path, sep, workers = override.rpartition('=')
+        if not sep or not workers.isdigit():
+            raise SystemExit(f'error: --device-workers expects PATH=N, got {override!r}')
+        device_workers[path] = int(workers)
+    return HashScheduler(hdd_workers=args.hdd_workers, ssd_workers=args.workers,
+                         algorithm=args.algorithm, device_workers=device_workers)
+
+def needs_hash(file, args):
+    #Digests from different algorithms cannot be compared, so redo them
+    return file.hash is None or file.hash_algorithm != args.algorithm
+
+def load_target(target, args):
+    '''
+    Builds a FileTree from a directory (by scanning it) or a catalog file
+    (by loading it). Falls back to --catalog when no target is given.
+    '''
+    if target is None:
+        target = args.catalog
+    if target is None:
+        raise SystemExit('error: a directory or catalog is required')
+    if os.path.isdir(target):
+        return FileTree.from_path(target, filters=args.filter)
+    return FileTree.load(target)
+
+def cmd_scan(args):
+    scanned = lambda file: emit(file_record('file', file))
+    filetree = FileTree.from_path(args.path, filters=args.filter, callback=scanned)
+    if args.hash:
+        for file in make_scheduler(args).run(filetree.iterfiles()):
+            emit(file_record('hash', file))
+    if args.catalog:
+        filetree.save(args.catalog)
+    emit({'event':'summary', 'root':filetree.root,
+          'files':sum(1 for file in filetree.iterfiles()), 'size':filetree.size})
+    return 0
+
+def cmd_hash(args):
+    filetree = load_target(args.target, args)
+    pending = [file for file in filetree.iterfiles()
+               if args.rehash or needs_hash(file, args)]
+    for file in make_scheduler(args).run(pending):
+        emit(file_record('hash', file))
+    if args.catalog:
+        filetree.save(args.catalog)
+    emit({'event':'summary', 'hashed':len(pending)})
+    return 0
+
+def cmd_dedup(args):
+    filetree = load_target(args.target, args)
+    files = filetree.iterfiles()
+
+    if args.partial:
+        from .chunking import find_partial_duplicates
+        report = find_partial_duplicates(files, args.min_ratio, args.workers,
+                                         max_fanout=args.max_fanout)
+        for file_a, file_b, shared, ratio in report['pairs']:
+            emit({'event':'partial', 'paths':[file_a.long_name, file_b.long_name],
+                  'shared_bytes':shared, 'ratio':ratio})
+        for group, shared, ratio in report['groups']:
+            emit({'event':'partial_group', 'paths':[file.long_name for file in group],
+                  'shared_bytes':shared, 'ratio':ratio})
+        emit({'event':'summary', 'total_bytes':report['total_bytes'],
+              'unique_bytes':report['unique_bytes'], 'savings':report['savings']})
+        return 0
+
+    #Only files sharing a size can be duplicates, so the rest are never read.
+    #A size group is reported as soon as its last member has been hashed.
+    by_size = {}
+    for file in files:
+        by_size.setdefault(file.size, []).append(file)
+    candidates = {size:group for size, group in by_size.items() if len(group) > 1}
+    remaining = {size:sum(needs_hash(f, args) for f in group) for size, group in candidates.items()}
+
+    def report_group(size):
+        by_hash = {}
+        for file in candidates[size]:
+            if not needs_hash(file, args):
+                by_hash.setdefault(file.hash, []).append(file)
+        groups = 0
+        for h, group in by_hash.items():
+            if len(group) > 1:
+                emit({'event':'duplicates', 'hash':h, 'size':size, 'count':len(group),
+                      'paths':[file.long_name for file in group]})
+                groups += 1
+        return groups
+
+    groups = 0
+    for size, count in remaining.items():
+        if count == 0:
+            groups += report_group(size)
+    pending = [file for group in candidates.values() for file in group if needs_hash(file, args)]
+    for file in make_scheduler(args).run(pending):
+        remaining[file.size] -= 1
+        if remaining[file.size] == 0:
+            groups += report_group(file.size)
+    #Files which vanished before hashing are never yielded by the scheduler
+    for size, count in remaining.items():
+        if count > 0:
+            groups += report_group(size)
+    emit({'event':'summary', 'groups':groups, 'hashed':len(pending)})
+    return 0
+
+def cmd_compare(args):
+    tree1 = load_target(args.first, args)
+    tree2 = load_target(args.second, args)
+    if args.hash:
+        scheduler = make_scheduler(args)
+        tree1.gethashes(scheduler=scheduler)
+        tree2.gethashes(scheduler=scheduler)
+    counts = {'added':0, 'removed':0, 'modified':0}
+    for status, relpath, file1, file2 in compare_directories(tree1, tree2):
+        counts[status] += 1
+        emit({'event':status, 'path':relpath,
+              'before':file1.decompose() if file1 is not None else None,
+              'after':file2.decompose() if file2 is not None else None})
+    record = {'event':'summary'}
+    record.update(counts)
+    emit(record)
+    return 0
+
+def cmd_refresh(args):
+    catalog = args.catalog_file or args.catalog
+    if catalog is None:
+        raise SystemExit('error: a catalog is required')
+    old = FileTree.load(catalog)
+    new = old.refresh(gethash=args.hash, scheduler=make_scheduler(args),
+                      filters=args.filter)
+    counts = {'added':0, 'removed':0, 'modified':0}
+    for status, relpath, file1, file2 in compare_directories(old, new):
+        counts[status] += 1
+        emit({'event':status, 'path':relpath,
+              'before':file1.decompose() if file1 is not None else None,
+              'after':file2.decompose() if file2 is not None else None})
+    new.save(catalog)
+    record = {'event':'summary', 'catalog':catalog}
+    record.update(counts)
+    emit(record)
+    return 0
+
+def cmd_usage(args):
+    filetree = load_target(args.target, args)
+    report = filetree.usage_report(args.top)
+    for directory in report['directories']:
+        largest = directory.largest
+        emit({'event':'directory', 'path':directory.root, 'size':directory.size,
+              'files':directory.n_files,
+              'largest':largest.long_name if largest is not None else None})
+    for file in report['largest_files']:
+        emit(file_record('file', file))
+    emit({'event':'summary', 'root':filetree.root, 'size':report['size'],
+          'files':report['files']})
+    return 0
+
+def cmd_snapshot(args):
+    from .snapshots import SnapshotStore
+    store = SnapshotStore(args.store, rebase_every=args.rebase_every)
+    filetree = load_target(args.target, args)
+    index = store.commit(filetree)
+    record = {'event':'snapshot'}
+    record.update(store.snapshots[index])
+    emit(record)
+    return 0
+
+def cmd_history(args):
+    from .snapshots import SnapshotStore
+    store = SnapshotStore(args.store)
+    path = os.path.abspath(args.path)
+    for index, timestamp, status, record in store.history(path):
+        emit({'event':status, 'snapshot':index, 'time':timestamp, 'record':record})
+    return 0
+
+def cmd_growth(args):
+    from .snapshots import SnapshotStore
+    store = SnapshotStore(args.store)
+    prefix = os.path.abspath(args.prefix) if args.prefix else None
+    for index, timestamp, size, files in store.growth(prefix):
+        emit({'event':'growth', 'snapshot':index, 'time':timestamp,
+              'size':size, 'files':files})
+    return 0
+
+def build_parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--workers', type=int, default=None,
+                        help='hashing threads per SSD, and chunking processes (default: CPU count)')
+    common.add_argument('--hdd-workers', type=int, default=1,
+                        help='hashing threads per spinning or unidentified disk (default: 1)')
+    common.add_argument('--device-workers', action='append', default=[], metavar='PATH=N',
+                        help='hashing threads for the disk holding PATH; may be repeated')
+    common.add_argument('--algorithm', choices=ALGORITHMS, default='sha256',
+                        help='hash algorithm; hashes made with another are recomputed (default: sha256)')
+    common.add_argument('--catalog', default=None,
+                        help='catalog file to read from or write to')
+    common.add_argument('--filter', action='append', default=[],
+                        help='file or directory name to skip; may be repeated')
+
+    parser = argparse.ArgumentParser(prog='mediamanager',
+                                     description='Scan, hash and compare media libraries. '
+                                     'Results are written to stdout as NDJSON.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    scan = commands.add_parser('scan', parents=[common], help='scan a directory')
+    scan.add_argument('path')
+    scan.add_argument('--hash', action='store_true', help='also hash every file')
+    scan.set_defaults(func=cmd_scan)
+
+    hashing = commands.add_parser('hash', parents=[common],
+                                  help='hash files in a directory or catalog')
+    hashing.add_argument('target', nargs='?', help='directory or catalog file')
+    hashing.add_argument('--rehash', action='store_true',
+                         help='recalculate existing hashes')
+    hashing.set_defaults(func=cmd_hash)
+
+    dedup = commands.add_parser('dedup', parents=[common], help='report duplicate files')
+    dedup.add_argument('target', nargs='?', help='directory or catalog file')
+    dedup.add_argument('--partial', action='store_true',
+                       help='report files sharing content, using chunk analysis')
+    dedup.add_argument('--min-ratio', type=float, default=0.5,
+                       help='minimum shared fraction for --partial (default: 0.5)')
+    dedup.add_argument('--max-fanout', type=int, default=64,
+                       help='with --partial, content shared by more files than this '
+                       'is reported as one group instead of pairs (default: 64)')
+    dedup.set_defaults(func=cmd_dedup)
+
+    compare = commands.add_parser('compare', parents=[common],
+                                  help='compare two directories or catalogs')
+    compare.add_argument('first')
+    compare.add_argument('second')
+    compare.add_argument('--hash', action='store_true',
+                         help='compare by hash, hashing files where needed')
+    compare.set_defaults(func=cmd_compare)
+
+    refresh = commands.add_parser('refresh', parents=[common],
+                                  help='rescan the directory behind a catalog and update it')
+    refresh.add_argument('catalog_file', nargs='?', help='catalog file')
+    refresh.add_argument('--hash', action='store_true',
+                         help='hash new and modified files')
+    refresh.set_defaults(func=cmd_refresh)
+
+    usage = commands.add_parser('usage', parents=[common],
+                                help='report the largest directories and files')
+    usage.add_argument('target', nargs='?', help='directory or catalog file')
+    usage.add_argument('--top', type=int, default=10,
+                       help='number of directories and files to report (default: 10)')
+    usage.set_defaults(func=cmd_usage)
+
+    snapshot = commands.add_parser('snapshot', parents=[common],
+                                   help='record a directory or catalog in a snapshot store')
+    snapshot.add_argument('store', help='snapshot store directory')
+    snapshot.add_argument('target', nargs='?', help='directory or catalog file')
+    snapshot.add_argument('--rebase-every', type=int, default=30,
+                          help='store a full base after this many deltas (default: 30)')
+    snapshot.set_defaults(func=cmd_snapshot)
+
+    history = commands.add_parser('history', parents=[common],
+                                  help='list the snapshots in which a file changed')
+    history.add_argument('store', help='snapshot store directory')
+    history.add_argument('path', help='file path')
+    history.set_defaults(func=cmd_history)
+
+    growth = commands.add_parser('growth', parents=[common],
+                                 help='report size and file count at each snapshot')
+    growth.add_argument('store', help='snapshot store directory')
+    growth.add_argument('--prefix', default=None,
+                        help='only count files below this directory')
+    growth.set_defaults(func=cmd_growth)
+
+    return parser
+
+def main(argv=None):
+    global _output
+    args = build_parser().parse_args(argv)
+    _output = sys.stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        return args.func(args)
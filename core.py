@@ -6,11 +6,12 @@ Created on Sun May  1 09:54:21 2022
 @author: tyler
 """
 
-import os, hashlib, json, shutil
+import os, sys, hashlib, json, shutil, heapq
+from collections import deque
 
 class File:
 
-    def __init__(self, filename, gethash=False):
+    def __init__(self, filename, gethash=False, scan=True):
 
         self.long_name = None
         self.short_name = None
@@ -18,10 +19,12 @@ class File:
         self.extension = None
         self.size = None
         self.hash = None
+        self.hash_algorithm = None      #hashlib name of algorithm behind self.hash
         self.last_modified = None
         self.last_accessed = None
         self.ctime = None
         self.tags = []
+        self.parent = None              #FileTree containing this file, if any
 
         if not os.path.isabs(filename):
             filename = os.path.abspath(filename)
@@ -34,7 +37,7 @@ class File:
         except IndexError:
             print(f'Could not identify file extension for file {filename}')
             
-        self._scan_params_(gethash=gethash)
+        if scan: self._scan_params_(gethash=gethash)
         
         return
     
@@ -70,28 +73,42 @@ class File:
             self.tags.remove(tag)
         return
 
-    def gethash(self, buffersize=2**20):
+    def gethash(self, buffersize=2**20, advise=False, algorithm='sha256'):
         '''
-        Calculate SHA-256 hash of file.
+        Calculate hash of file, SHA-256 by default.
 
         Parameters
         ----------
         buffersize : int, optional
             Size of buffer for digesting file, in bytes. The default is 2**20.
+        advise : bool, optional
+            Tell the kernel the file is read sequentially and once, so large
+            files do not evict the page cache. Ignored where posix_fadvise is
+            unavailable. The default is False.
+        algorithm : str, optional
+            Name of any algorithm supported by hashlib.new. Hashes are only
+            comparable between files using the same algorithm.
+            The default is 'sha256'.
 
         Returns
         -------
         self.hash : str
-            SHA-256 hash of file.
+            Hex digest of file.
         '''
-        hasher = hashlib.sha256()
+        hasher = hashlib.new(algorithm)
+        advise = advise and hasattr(os, 'posix_fadvise')
         
         block = [None]
         with open(self.long_name, 'rb') as f:
+            if advise:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
             while len(block) > 0:
                 block = f.read(buffersize)
                 hasher.update(block)
+            if advise:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
         self.hash = hasher.hexdigest()
+        self.hash_algorithm = algorithm
         return self.hash
 
     def decompose(self):
@@ -108,6 +125,7 @@ class File:
             'fullname':self.long_name,
             'size':self.size,
             'hash':self.hash,
+            'algorithm':self.hash_algorithm,
             'modified':self.last_modified,
             'accessed':self.last_accessed,
             'created':self.ctime,
@@ -118,7 +136,8 @@ class File:
     @staticmethod
     def fromdict(dictionary):
         '''
-        Generates File object from metadata dictionary.
+        Generates File object from metadata dictionary. The filesystem is
+        not accessed, so files which have since moved can still be loaded.
 
         Parameters
         ----------
@@ -132,10 +151,13 @@ class File:
 
         '''
         fullname = dictionary['fullname']
-        file = File(fullname)
+        file = File(fullname, scan=False)
         file.size = dictionary['size']
         file.hash = dictionary['hash']
-        file.last_mofified = dictionary['modified']
+        #Catalogs written before the algorithm was recorded only used SHA-256
+        default = 'sha256' if file.hash is not None else None
+        file.hash_algorithm = dictionary.get('algorithm', default)
+        file.last_modified = dictionary['modified']
         file.last_accessed = dictionary['accessed']
         file.ctime = dictionary['created']
         file.tags = dictionary['tags']
@@ -144,18 +166,23 @@ class File:
 
     def delete(self):
         '''
-        Deletes the file from filesystem (if it exists).
+        Deletes the file from filesystem (if it exists), and removes it from
+        its FileTree.
         '''
         try:
             os.remove(self.long_name)
         except OSError:
-            print(f'WARNING:File {self.fullname} could not be deleted!')
+            print(f'WARNING:File {self.long_name} could not be deleted!')
+            return
+        if self.parent is not None:
+            del self.parent[self.short_name]
         return
     
     def rescan(self, gethash=False):
         '''
         Wrapper for self._scan_params_
         Intended use is to update file parameters after possible modification.
+        Size totals of the containing FileTrees are updated to match.
 
         Parameters
         ----------
@@ -167,14 +194,18 @@ class File:
         None.
 
         '''
+        old_size = self.size
         self._scan_params_(gethash)
+        if self.parent is not None:
+            self.parent._file_resized(self, old_size)
         return
     
     def move(self, new_path):
         '''
         Moves data associated with File to a new location on the hard drive,
-        updates relevant attributes. Does not update file position in any
-        linked FileTrees.
+        updates relevant attributes. If the file belongs to a FileTree it is
+        moved to the matching subdirectory, or removed from the tree if the
+        new location is outside it.
 
         Parameters
         ----------
@@ -191,25 +222,159 @@ class File:
         dst = os.path.join(new_path, self.short_name)
         #Move file data
         shutil.move(src, dst)
+        #Detach from current FileTree, remembering its root
+        tree = self.parent
+        if tree is not None:
+            del tree[self.short_name]
+            while tree.parent is not None:
+                tree = tree.parent
         #Update File attributes
         self.long_name = dst
         head, tail = os.path.split(self.long_name)
         self.short_name = tail
         self.location = new_path
+        #Reattach under new location
+        if tree is not None:
+            destination = tree.subtree(new_path)
+            if destination is not None:
+                destination[self.short_name] = self
         return
         
     
 class FileTree(dict):
+    '''
+    Dictionary of File objects and sub-FileTrees, keyed by short name.
+    Cumulative size, file count and largest file are kept up to date as
+    items are added, removed, rescanned or moved.
+    '''
     
     def __init__(self):
         dict.__init__(self)
         self.root = None
-        self.size = 0.0
+        self.parent = None              #FileTree containing this one, if any
+        self.size = 0.0                 #Cumulative size of all files below, in bytes
+        self.n_files = 0                #Cumulative number of files below
+        self._largest = None
+        self._largest_stale = False
         return
     
     def __iter__(self):
         for item in self.items():
             yield item
+
+    def __setitem__(self, key, item):
+        if key in self:
+            del self[key]
+        dict.__setitem__(self, key, item)
+        item.parent = self
+        if type(item) is FileTree:
+            self._adjust(item.size, item.n_files)
+            self._offer_largest(item.largest)
+        else:
+            self._adjust(item.size or 0, 1)
+            self._offer_largest(item)
+        return
+
+    def __delitem__(self, key):
+        item = self[key]
+        dict.__delitem__(self, key)
+        item.parent = None
+        if type(item) is FileTree:
+            self._adjust(-item.size, -item.n_files)
+            self._drop_largest(item.largest)
+        else:
+            self._adjust(-(item.size or 0), -1)
+            self._drop_largest(item)
+        return
+
+    def pop(self, key, *default):
+        if key not in self and default:
+            return default[0]
+        item = self[key]
+        del self[key]
+        return item
+
+    def _adjust(self, nbytes, nfiles):
+        tree = self
+        while tree is not None:
+            tree.size += nbytes
+            tree.n_files += nfiles
+            tree = tree.parent
+        return
+
+    def _offer_largest(self, file):
+        if file is None:
+            return
+        tree = self
+        while tree is not None:
+            #Stale nodes recompute on access, but ancestors may still need it
+            if tree._largest_stale:
+                tree = tree.parent
+                continue
+            current = tree._largest
+            if current is not None and (current.size or 0) >= (file.size or 0):
+                break
+            tree._largest = file
+            tree = tree.parent
+        return
+
+    def _drop_largest(self, file):
+        #Ancestors whose largest file was this one must recompute on demand
+        tree = self
+        while tree is not None and file is not None and tree._largest is file:
+            tree._largest = None
+            tree._largest_stale = True
+            tree = tree.parent
+        return
+
+    def _file_resized(self, file, old_size):
+        new_size = file.size or 0
+        old_size = old_size or 0
+        self._adjust(new_size - old_size, 0)
+        if new_size > old_size:
+            self._offer_largest(file)
+        elif new_size < old_size:
+            self._drop_largest(file)
+        return
+
+    @property
+    def largest(self):
+        '''
+        Largest File in this directory or any subdirectory, or None if empty.
+        '''
+        if self._largest_stale:
+            largest = None
+            for item in self.values():
+                if type(item) is FileTree:
+                    item = item.largest
+                if item is not None and (largest is None or (item.size or 0) > (largest.size or 0)):
+                    largest = item
+            self._largest = largest
+            self._largest_stale = False
+        return self._largest
+
+    def subtree(self, path, create=False):
+        '''
+        Returns the FileTree for the directory at an absolute path, or None if
+        the path is not inside this filetree. Set create=True to add any
+        missing directories along the way.
+        '''
+        relpath = os.path.relpath(path, self.root)
+        if relpath == os.curdir:
+            return self
+        if relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+            return None
+        tree = self
+        for name in relpath.split(os.sep):
+            child = tree.get(name)
+            if child is None and create:
+                child = FileTree()
+                child.root = os.path.join(tree.root, name)
+                tree[name] = child
+            if type(child) is not FileTree:
+                return None
+            tree = child
+        return tree
     
     def decompose(self):
         toplevel = {}
@@ -244,14 +409,12 @@ class FileTree(dict):
             filetree.root = path
             for key, (item_type, item) in contents.items():
                 if item_type == 'file':
-                    file = File.fromdict(item)                  #Fails when target file has been moved
+                    file = File.fromdict(item)
                     filetree[file.short_name] = file
-                    filetree.size += file.size
                 elif item_type == 'dir':
                     subdir = construct_subdirectory(key, item)
                     head, tail = os.path.split(subdir.root)
                     filetree[tail] = subdir
-                    filetree.size += subdir.size
             return filetree
         
         filetree = construct_toplevel()
@@ -261,19 +424,39 @@ class FileTree(dict):
             if item_type == 'file':
                 file = File.fromdict(item)
                 filetree[file.short_name] = file
-                filetree.size += file.size
             elif item_type == 'dir':
                 subdir = construct_subdirectory(key, item)
                 head, tail = os.path.split(key)
                 filetree[tail] = subdir
-                filetree.size += subdir.size
                 
         return filetree
     
     @staticmethod
-    def from_path(path, gethash=False, filters=[]):
+    def from_path(path, gethash=False, filters=[], callback=None):
+        '''
+        Builds FileTree by scanning a directory on disk.
+
+        Parameters
+        ----------
+        path : str
+            Directory to be scanned.
+        gethash : bool, optional
+            Calculate hashes for all files once the scan is complete.
+            The default is False.
+        filters : list, optional
+            File and directory names to be skipped. The default is [].
+        callback : callable, optional
+            Called with each File object as soon as it has been scanned.
+            The default is None.
+
+        Returns
+        -------
+        filetree : FileTree
+            Scanned filetree.
+
+        '''
         if not os.path.isabs(path):
-            path = os.path.asabs(path)
+            path = os.path.abspath(path)
         filetree = FileTree()
         filetree.root = path
         for item in os.listdir(path):
@@ -285,17 +468,49 @@ class FileTree(dict):
             fullpath = os.path.join(path, item)
 
             if os.path.isdir(fullpath):
-                subdir = FileTree().from_path(fullpath, filters)
+                subdir = FileTree.from_path(fullpath, filters=filters, callback=callback)
                 filetree[item] = subdir
-                filetree.size += subdir.size
             else:
-                file = File(fullpath, gethash)
+                file = File(fullpath)
                 filetree[item] = file
-                filetree.size += file.size
-                
+                if callback is not None: callback(file)
+
+        #Hash once the whole tree is known, so reads can be ordered on disk
+        if gethash: filetree.gethashes()
         return filetree
         
     
+    @staticmethod
+    def from_records(root, records):
+        '''
+        Builds FileTree from flat file metadata dictionaries, as produced by
+        File.decompose. Directories are created as needed; directories which
+        contained no files are not represented.
+
+        Parameters
+        ----------
+        root : str
+            Absolute path of the top-level directory.
+        records : iterable
+            File metadata dictionaries, all located below root.
+
+        Returns
+        -------
+        filetree : FileTree
+            Reconstituted filetree.
+
+        '''
+        filetree = FileTree()
+        filetree.root = root
+        for record in records:
+            file = File.fromdict(record)
+            directory = filetree.subtree(file.location, create=True)
+            if directory is None:
+                print(f'WARNING:File {file.long_name} is outside {root}, skipping.', file=sys.stderr)
+                continue
+            directory[file.short_name] = file
+        return filetree
+
     @staticmethod
     def from_json(jsond):
         decomposed = json.loads(jsond)
@@ -307,13 +522,79 @@ class FileTree(dict):
         with open(filename, 'r') as f:
             jsond = f.read()
         filetree = FileTree.from_json(jsond)
-        return filetree[list(filetree.keys())[0]]
+        return filetree
+
+    def gethashes(self, rehash=False, scheduler=None):
+        '''
+        Calculates hashes for all files in filetree, reading them in an
+        order suited to the underlying disks. See scheduler.HashScheduler.
+
+        Parameters
+        ----------
+        rehash : bool, optional
+            Recalculate hashes which have already been calculated. Hashes
+            made with a different algorithm than the scheduler's are always
+            recalculated. The default is False.
+        scheduler : HashScheduler, optional
+            Scheduler used to order and run the work. The default is a
+            HashScheduler with default settings.
+
+        Returns
+        -------
+        None.
+
+        '''
+        from .scheduler import HashScheduler
+        if scheduler is None:
+            scheduler = HashScheduler()
+        pending = [item for item in self.iterfiles()
+                   if rehash or item.hash is None
+                   or item.hash_algorithm != scheduler.algorithm]
+        for file in scheduler.run(pending):
+            pass
+        return
+
+    def refresh(self, gethash=False, scheduler=None, filters=[]):
+        '''
+        Rescans the directory this filetree was built from. Hashes and tags
+        are carried over from this filetree for files whose size and
+        modification time are unchanged.
+
+        Parameters
+        ----------
+        gethash : bool, optional
+            Calculate hashes for new and modified files. The default is False.
+        scheduler : HashScheduler, optional
+            Scheduler used for hashing. The default is None.
+        filters : list, optional
+            File and directory names to be skipped. The default is [].
+
+        Returns
+        -------
+        refreshed : FileTree
+            New filetree reflecting the current state of the directory.
+
+        '''
+        known = self.flatten()
+        refreshed = FileTree.from_path(self.root, filters=filters)
+        for file in refreshed.iterfiles():
+            path = file.long_name
+            old = known.get(path)
+            if old is None:
+                continue
+            file.tags = list(old.tags)
+            if old.size == file.size and old.last_modified == file.last_modified:
+                file.hash = old.hash
+                file.hash_algorithm = old.hash_algorithm
+        if gethash: refreshed.gethashes(scheduler=scheduler)
+        return refreshed
 
     def find_duplicates(self, filters=None):
         '''
         Searches for duplicate files within filetree. Duplicates are detected
         by comparing SHA-256 hashes. Calculates hash for all files if not
-        calculated previously.
+        calculated previously, using gethashes. Files which cannot be read
+        are skipped.
         
         Filters parameter currently not functional.
 
@@ -328,14 +609,16 @@ class FileTree(dict):
             Dictionary summarizing all detected duplicate files.
 
         '''
-        flattened = self.flatten()
+        from .scheduler import HashScheduler
+        scheduler = HashScheduler()
+        self.gethashes(scheduler=scheduler)
         hashes = {}
 
-        for path, item in flattened.items():
+        for item in self.iterfiles():
             h = item.hash
-            if h is None:
-                item.gethash()
-                h = item.hash
+            #Unreadable files keep their old hash, possibly from another algorithm
+            if h is None or item.hash_algorithm != scheduler.algorithm:
+                continue
             if h in hashes:
                 hashes[h][0] += 1
                 hashes[h].append(item)
@@ -348,16 +631,99 @@ class FileTree(dict):
                 duplicates[k] = v
         return duplicates
 
+    def find_partial_duplicates(self, min_ratio=0.5, workers=None, max_fanout=64):
+        '''
+        Searches for files sharing most of their content (e.g. re-muxed
+        videos or appended logs) using content-defined chunking. Also
+        estimates the space block-level deduplication would save.
+
+        Parameters
+        ----------
+        min_ratio : float, optional
+            Minimum fraction of the smaller file's bytes which must be shared
+            for a pair to be reported. The default is 0.5.
+        workers : int, optional
+            Number of processes used for chunking. The default is
+            os.cpu_count().
+        max_fanout : int, optional
+            Content shared by more files than this is reported as a group
+            rather than as pairs. The default is 64.
+
+        Returns
+        -------
+        report : dict
+            Dictionary of matching file pairs and deduplication estimates.
+            See chunking.find_partial_duplicates.
+
+        '''
+        from .chunking import find_partial_duplicates
+        return find_partial_duplicates(self.iterfiles(), min_ratio, workers,
+                                       max_fanout=max_fanout)
+
+    def walk(self, order='depth', prune=None):
+        '''
+        Lazily traverses the filetree, without copying it. Only the
+        directories still to be visited are held in memory.
+
+        Parameters
+        ----------
+        order : str, optional
+            'depth' for depth-first (pre-order) traversal, 'breadth' for
+            breadth-first. The default is 'depth'.
+        prune : callable, optional
+            Called with each subdirectory FileTree before it is visited;
+            returning True skips it and everything below it.
+            The default is None.
+
+        Yields
+        ------
+        directory : FileTree
+            Directory being visited.
+        files : list
+            File objects directly inside that directory.
+
+        '''
+        if order == 'depth':
+            pending = [self]
+            take = pending.pop
+        elif order == 'breadth':
+            pending = deque([self])
+            take = pending.popleft
+        else:
+            raise ValueError(f'Unknown traversal order "{order}"')
+
+        while pending:
+            directory = take()
+            files = []
+            subdirs = []
+            for item in directory.values():
+                if type(item) is FileTree:
+                    if prune is None or not prune(item):
+                        subdirs.append(item)
+                else:
+                    files.append(item)
+            yield directory, files
+            if order == 'depth':
+                #Reversed so that subdirectories are visited in listing order
+                subdirs.reverse()
+            pending.extend(subdirs)
+        return
+
+    def iterfiles(self, order='depth', prune=None):
+        '''
+        Lazily yields every File object in the filetree. See walk for a
+        description of the parameters.
+        '''
+        for directory, files in self.walk(order, prune):
+            yield from files
+        return
+
     def flatten(self):
-        flattened = {}
-        for path, item in self:
-            if type(item) is File:
-                flattened[item.long_name] = item
-            else:
-                subdir_flat = item.flatten()
-                for path, item in subdir_flat.items():
-                    flattened[path] = item
-        return flattened
+        '''
+        Returns dictionary mapping absolute path to File object for every
+        file in the filetree. Prefer iterfiles when a mapping is not needed.
+        '''
+        return {item.long_name:item for item in self.iterfiles()}
     
     def add_tag(self, tag, recursive=False):
         '''
@@ -377,12 +743,9 @@ class FileTree(dict):
         None.
 
         '''
-        for item in self.values():
-            if type(item) == File:
-                item.add_tag(tag)
-            elif type(item) == FileTree:
-                if recursive == True:
-                    item.add_tag(tag)
+        prune = None if recursive else (lambda subdir: True)
+        for item in self.iterfiles(prune=prune):
+            item.add_tag(tag)
         return
     
     def add_file(self, filename):
@@ -390,6 +753,53 @@ class FileTree(dict):
         self[newfile.short_name] = newfile
         return
 
+    def usage_report(self, top=10):
+        '''
+        Summarizes disk usage, du-style. Directory sizes come from the
+        maintained totals, so a single streaming pass with bounded heaps
+        is enough to select the largest directories and files.
+
+        Parameters
+        ----------
+        top : int, optional
+            Number of directories and files to report. The default is 10.
+
+        Returns
+        -------
+        report : dict
+            Dictionary containing total size, file count, and lists of the
+            largest directories (FileTree) and files (File), largest first.
+
+        '''
+        top_dirs = []
+        top_files = []
+        #Entries are (size, tiebreak, item); tiebreak keeps items uncompared
+        counter = 0
+        #With top <= 0 there is nothing to select, and the heaps stay empty
+        walk = self.walk() if top > 0 else ()
+        for directory, files in walk:
+            counter += 1
+            entry = (directory.size, counter, directory)
+            if len(top_dirs) < top:
+                heapq.heappush(top_dirs, entry)
+            elif entry[0] > top_dirs[0][0]:
+                heapq.heapreplace(top_dirs, entry)
+            for file in files:
+                counter += 1
+                entry = (file.size or 0, counter, file)
+                if len(top_files) < top:
+                    heapq.heappush(top_files, entry)
+                elif entry[0] > top_files[0][0]:
+                    heapq.heapreplace(top_files, entry)
+
+        report = {
+            'size':self.size,
+            'files':self.n_files,
+            'directories':[item for size, n, item in sorted(top_dirs, reverse=True)],
+            'largest_files':[item for size, n, item in sorted(top_files, reverse=True)]
+            }
+        return report
+
 class Directory(dict):
 
     def __init__(self, root, gethash=False, filters=[]):
@@ -397,27 +807,41 @@ class Directory(dict):
         dict.__init__(self)
         self.long_name = None           #Absolute directory path
         self.short_name = None          #Relative directory path
-        self.size = 0.0                 #Cumulative size of objects in directory and all subdirectories, in bytes
         self.tags = []
         self.filetree = None
         
         if not os.path.isabs(root):
-            root = os.path.asabs(root)
+            root = os.path.abspath(root)
         self.long_name = root
         self.short_name = os.path.split(self.long_name)[-1]
         
         self.populate_filetree(gethash, filters)
         
-        self.size = float(self.filetree.size)
-        
         return
 
+    @property
+    def size(self):
+        #Cumulative size of objects in directory and all subdirectories, in bytes
+        return self.filetree.size
+
     def __iter__(self):
         for item in self.filetree.items():
             yield item
             
     def find_duplicates(self):
         return self.filetree.find_duplicates()
+
+    def walk(self, order='depth', prune=None):
+        return self.filetree.walk(order, prune)
+
+    def iterfiles(self, order='depth', prune=None):
+        return self.filetree.iterfiles(order, prune)
+
+    def flatten(self):
+        return self.filetree.flatten()
+
+    def usage_report(self, top=10):
+        return self.filetree.usage_report(top)
     
     def populate_filetree(self, gethash=False, filters=[]):
         self.filetree = FileTree().from_path(self.long_name)                
@@ -446,16 +870,51 @@ def build_filetree(root, buffersize=2**20, toplevel=True):
     return tree
 
 def compare_directories(directory1, directory2):
+    '''
+    Compares two filetrees, matching files by path relative to each root.
+    Files are compared by hash where both have been hashed with the same
+    algorithm, otherwise by
+    size and modification time. Only the first filetree is indexed; the
+    second is streamed.
+
+    Parameters
+    ----------
+    directory1 : FileTree or Directory
+        Reference directory.
+    directory2 : FileTree or Directory
+        Directory compared against the reference.
+
+    Yields
+    ------
+    difference : tuple
+        (status, relative path, file1, file2), where status is 'removed',
+        'added' or 'modified', and the missing side of a pair is None.
+
+    '''
+    def relative_files(directory):
+        if type(directory) is Directory:
+            directory = directory.filetree
+        for item in directory.iterfiles():
+            yield os.path.relpath(item.long_name, directory.root), item
+        return
 
-    def flatten_directory(directory):
-        flattened = []
-        for item in directory:
-            if type(item) is File:
-                flattened.append(item.decompose())
-            else:
-                subdir = flatten_directory(item)
-                flattened += subdir
-        return flattened
+    def differ(file1, file2):
+        if (file1.hash is not None and file2.hash is not None
+                and file1.hash_algorithm == file2.hash_algorithm):
+            return file1.hash != file2.hash
+        return (file1.size != file2.size
+                or file1.last_modified != file2.last_modified)
+
+    unmatched = dict(relative_files(directory1))
+    for relpath, file2 in relative_files(directory2):
+        file1 = unmatched.pop(relpath, None)
+        if file1 is None:
+            yield ('added', relpath, None, file2)
+        elif differ(file1, file2):
+            yield ('modified', relpath, file1, file2)
+    for relpath, file1 in unmatched.items():
+        yield ('removed', relpath, file1, None)
+    return
 
 
 if __name__ == '__main__':
@@ -106,35 +106,24 @@ class ScanResult(Slave):
         return
     
     def duplicate_search(self):
-        flattened = self.directory.flatten()
-        unique_hashes = set()
-        all_hashes = []
-        for file in flattened:
-            if file.hash is None: file.gethash()
-            unique_hashes.add(file.hash)
-            all_hashes.append(file.hash)
-            
-        matches = {}
-        for h in list(unique_hashes):
-            if all_hashes.count(h) > 1:
-                hits = []
-                for file in flattened:
-                    if file.hash == h:
-                        hits.append(file)
-                matches[h] = hits
+        duplicates = self.directory.find_duplicates()
+        #Strip the leading count from each entry, leaving only File objects
+        matches = {h:hits[1:] for h, hits in duplicates.items()}
         
         if len(matches) > 0:
             summary_window = DuplicateSummary(self, matches)
         return matches
 
+    def usage_report(self):
+        report = self.directory.usage_report(top=25)
+        usage_window = UsageReport(self, report)
+        return report
+
     def populate(self):
         
         #Extract report info
-        flat = self.directory.flatten()
-        n_files = len(flat)
-        total_size = 0
-        for f in flat:
-            total_size += f.filesize
+        n_files = self.directory.filetree.n_files
+        total_size = self.directory.size
         #Basic info
         
         #Labels
@@ -142,12 +131,13 @@ class ScanResult(Slave):
         tk.Label(self.frame, text='Total Files:').grid(column=0,row=1)
         tk.Label(self.frame, text='Total directory size:').grid(column=0,row=2)
         #Data
-        tk.Label(self.frame, text=self.directory.location).grid(column=1, row=0)
+        tk.Label(self.frame, text=self.directory.long_name).grid(column=1, row=0)
         tk.Label(self.frame, text=n_files).grid(column=1, row=1)
         tk.Label(self.frame, text=f'{total_size/(1000**2)} MB').grid(column=1, row=2)
         #Buttons
         tk.Button(self.frame, text='Close', command=self.close_nicely).grid(column=2, row=5)
         tk.Button(self.frame, text='Find Duplicates', command=self.duplicate_search).grid(column=1, row=5)
+        tk.Button(self.frame, text='Disk Usage', command=self.usage_report).grid(column=0, row=5)
        
         
         #Data table
@@ -175,11 +165,11 @@ class ScanResult(Slave):
         
         # sb = tk.Scrollbar(self.frame, orient='vertical')
         # sb.config(command=sb.yview)
-        for i, item in enumerate(flat):
+        for i, item in enumerate(self.directory.iterfiles()):
             index = i + 1
-            filename = item.fullname
+            filename = item.long_name
             folder, fname = os.path.split(filename)
-            size = item.filesize / (1000**2)
+            size = item.size / (1000**2)
             size = f'{size:.05}'
             filehash = item.hash
             extension = filename.split('.')[-1].lower()
@@ -202,10 +192,14 @@ class DuplicateSummary(Slave):
         
         def delete_selected_file():
             index = self.hashtable.focus()
-            current_item = self.hashtable.item(index)
-            filename = current_item['values'][-1]
-            os.remove(filename)
-            self.hashtable.delete(index)
+            file = self.row_files.get(index)
+            if file is None:
+                return
+            #File.delete keeps the directory totals used by other views current
+            file.delete()
+            if not os.path.exists(file.long_name):
+                del self.row_files[index]
+                self.hashtable.delete(index)
             return
         
         def show_selected_file():
@@ -255,7 +249,7 @@ class DuplicateSummary(Slave):
         
         sizes =[]
         for i, (h, item) in enumerate(self.duplicates.items()):
-            sizes.append(item[0].filesize / (1000**2))
+            sizes.append(item[0].size / (1000**2))
         
         keys = list(self.duplicates.keys())
         # sortorder = proxy_sort(sizes, keys, reverse=True)
@@ -266,7 +260,7 @@ class DuplicateSummary(Slave):
         for i, h in enumerate(keys):
             item = self.duplicates[h]
             index = i + 1
-            size = item[0].filesize / (1000**2)
+            size = item[0].size / (1000**2)
             size = f'{size:.05}'
             filehash = h
             n_dup = len(item)
@@ -274,10 +268,12 @@ class DuplicateSummary(Slave):
             self.hashtable.insert(parent='', index=index, iid=i, text='', values=packaged)
             
         ii = int(i) + 1
+        self.row_files = {}             #Treeview iid -> File, for file rows
         for i, (h, item) in enumerate(self.duplicates.items()):
             for j, file in enumerate(item):
-                packaged = ('','','','',file.fullname)
+                packaged = ('','','','',file.long_name)
                 index = self.hashtable.insert(parent=i, index=j+1, iid=ii, text='', values=packaged)
+                self.row_files[index] = file
                 ii += 1
             
         self.hashtable.grid(column=1, row=1)
@@ -298,6 +294,52 @@ class DuplicateSummary(Slave):
         
         return
         
+class UsageReport(Slave):
+
+    def __init__(self, master, report):
+        Slave.__init__(self, master)
+        self.report = report
+        self.populate()
+
+    def populate(self):
+
+        #Summary labels
+        ttk.Label(self.frame, text=f'Total size:\t{self.report["size"]/(1000**2):.05} MB').grid(column=1, row=0)
+        ttk.Label(self.frame, text=f'Total files:\t{self.report["files"]}').grid(column=1, row=1)
+
+        #Largest directories
+        ttk.Label(self.frame, text='Largest directories').grid(column=1, row=2)
+        self.dirtable = ttk.Treeview(self.frame, columns=('index','size','n_files','largest','location'))
+        self.dirtable.column('#0', width=0, stretch=False)
+        self.dirtable.heading('index', text='Index', anchor='n')
+        self.dirtable.heading('size', text='Size (MB)', anchor='n')
+        self.dirtable.heading('n_files', text='# Files', anchor='n')
+        self.dirtable.heading('largest', text='Largest File', anchor='n')
+        self.dirtable.heading('location', text='Location', anchor='n')
+        for i, directory in enumerate(self.report['directories']):
+            size = f'{directory.size / (1000**2):.05}'
+            largest = directory.largest
+            largest = largest.short_name if largest is not None else ''
+            packaged = (i + 1, size, directory.n_files, largest, directory.root)
+            self.dirtable.insert(parent='', index=i, iid=i, text='', values=packaged)
+        self.dirtable.grid(column=1, row=3)
+
+        #Largest files
+        ttk.Label(self.frame, text='Largest files').grid(column=1, row=4)
+        self.filetable = ttk.Treeview(self.frame, columns=('index','size','location'))
+        self.filetable.column('#0', width=0, stretch=False)
+        self.filetable.heading('index', text='Index', anchor='n')
+        self.filetable.heading('size', text='Size (MB)', anchor='n')
+        self.filetable.heading('location', text='Location', anchor='n')
+        for i, file in enumerate(self.report['largest_files']):
+            size = f'{(file.size or 0) / (1000**2):.05}'
+            packaged = (i + 1, size, file.long_name)
+            self.filetable.insert(parent='', index=i, iid=i, text='', values=packaged)
+        self.filetable.grid(column=1, row=5)
+
+        ttk.Button(self.frame, text='Close', command=self.close).grid(column=2, row=6)
+        return
+
 def proxy_sort(template, data, reverse=False):
     import numpy as np
     order = np.argsort(template)
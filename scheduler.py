@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+I/O-ordered hashing scheduler.
+
+Hashing files in directory-listing order makes spinning disks seek constantly.
+HashScheduler groups files by physical disk (so partitions of one spindle
+share a pool, and filesystems without a block device of their own, such as
+btrfs or overlayfs, are traced back to the disks holding them), orders each group by physical extent (or inode, where extents
+are unavailable), and hashes each group with a thread pool sized to the
+disk: narrow for rotational or unidentified disks, wide for SSDs.
+"""
+
+import os, sys, stat, struct
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+#Linux FIEMAP ioctl, used to find the physical location of a file's data
+_FS_IOC_FIEMAP = 0xC020660B
+_FIEMAP_HEADER = struct.Struct('=QQLLLL')
+_FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')
+#Extent flags meaning fe_physical is not a usable disk position: location
+#unknown, not yet allocated (delayed allocation), or data stored inline
+_FIEMAP_EXTENT_UNKNOWN = 0x2
+_FIEMAP_EXTENT_DELALLOC = 0x4
+_FIEMAP_EXTENT_DATA_INLINE = 0x200
+_FIEMAP_UNPLACED = _FIEMAP_EXTENT_UNKNOWN | _FIEMAP_EXTENT_DELALLOC | _FIEMAP_EXTENT_DATA_INLINE
+
+def physical_offset(filename):
+    '''
+    Returns the physical byte offset of the first extent of a file, or None
+    if it cannot be determined (non-Linux platforms, unsupported filesystems,
+    empty files, extents whose location is unknown or not yet allocated).
+    '''
+    if not sys.platform.startswith('linux'):
+        return None
+    import fcntl
+    request = bytearray(_FIEMAP_HEADER.pack(0, 2**64 - 1, 0, 0, 1, 0))
+    request += bytes(_FIEMAP_EXTENT.size)
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        fcntl.ioctl(fd, _FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    mapped = _FIEMAP_HEADER.unpack_from(request)[3]
+    if mapped == 0:
+        return None
+    extent = _FIEMAP_EXTENT.unpack_from(request, _FIEMAP_HEADER.size)
+    if extent[5] & _FIEMAP_UNPLACED:
+        return None
+    return extent[1]
+
+def whole_disk(device):
+    '''
+    Returns the sysfs directory of the whole disk holding a device (as given
+    by os.stat().st_dev), resolving partitions to their parent disk. Returns
+    None for devices with no block device behind them, such as network,
+    FUSE and btrfs filesystems, or on non-Linux platforms; see backing_disks.
+    '''
+    major, minor = os.major(device), os.minor(device)
+    path = os.path.realpath(f'/sys/dev/block/{major}:{minor}')
+    if not os.path.isdir(path):
+        return None
+    if os.path.exists(os.path.join(path, 'partition')):
+        path = os.path.dirname(path)
+    return path
+
+#Filesystems held in memory, which are never worth throttling
+_MEMORY_FS = {'tmpfs', 'ramfs'}
+
+def _unescape(field):
+    #mountinfo escapes spaces, tabs, newlines and backslashes as octal
+    return field.encode().decode('unicode_escape').encode('latin-1').decode(errors='surrogateescape')
+
+def mount_info(device, path=None):
+    '''
+    Looks up the mount of a device in /proc/self/mountinfo. Devices not
+    listed there (e.g. btrfs subvolumes below a mount) are matched by the
+    deepest mount point holding path, if given.
+
+    Returns
+    -------
+    mount : tuple
+        (filesystem type, mount source, superblock options) tuple, or None
+        if the mount cannot be found.
+    '''
+    numbers = f'{os.major(device)}:{os.minor(device)}'
+    mounts = []
+    try:
+        with open('/proc/self/mountinfo', 'r') as f:
+            for line in f:
+                fields, sep, tail = line.rstrip('\n').partition(' - ')
+                fields = fields.split(' ')
+                tail = tail.split(' ')
+                if not sep or len(fields) < 5 or len(tail) < 3:
+                    continue
+                mount = (tail[0], _unescape(tail[1]), tail[2])
+                if fields[2] == numbers:
+                    return mount
+                mounts.append((_unescape(fields[4]), mount))
+    except OSError:
+        return None
+    if path is None:
+        return None
+    path = os.path.realpath(path)
+    best = None
+    for point, mount in mounts:
+        if path == point or path.startswith(point.rstrip(os.sep) + os.sep):
+            if best is None or len(point) > len(best[0]):
+                best = (point, mount)
+    return best[1] if best is not None else None
+
+def _btrfs_members(disk):
+    #Every device of the btrfs filesystem one of whose devices is disk
+    for devices in _glob_dirs('/sys/fs/btrfs', 'devices'):
+        members = [os.path.realpath(os.path.join(devices, name))
+                   for name in os.listdir(devices)]
+        if disk in members:
+            return members
+    return [disk]
+
+def _glob_dirs(parent, child):
+    try:
+        names = os.listdir(parent)
+    except OSError:
+        return []
+    return [os.path.join(parent, name, child) for name in names
+            if os.path.isdir(os.path.join(parent, name, child))]
+
+def backing_disks(device, path=None):
+    '''
+    Returns the sysfs directories of the whole disks holding a device (as
+    given by os.stat().st_dev). Devices with no block device of their own
+    are traced through their mount in /proc/self/mountinfo: btrfs to every
+    disk of the filesystem, overlayfs to the disks of its upper directory,
+    and other filesystems mounted from a device node to that device.
+
+    Parameters
+    ----------
+    device : int
+        Device number.
+    path : str, optional
+        Any path on the device, used to find the mount of btrfs subvolumes
+        whose device numbers are not listed as mounts. The default is None.
+
+    Returns
+    -------
+    disks : list
+        List of sysfs directories, empty if none can be found (network and
+        FUSE filesystems, ZFS, memory filesystems, non-Linux platforms).
+    '''
+    disk = whole_disk(device)
+    if disk is not None:
+        return [disk]
+    mount = mount_info(device, path)
+    if mount is None:
+        return []
+    fstype, source, options = mount
+    if fstype == 'overlay':
+        for option in options.split(','):
+            if option.startswith('upperdir='):
+                upper = _unescape(option[len('upperdir='):])
+                try:
+                    upper_device = os.stat(upper).st_dev
+                except OSError:
+                    return []
+                if upper_device == device:
+                    return []
+                return backing_disks(upper_device, upper)
+        return []
+    try:
+        st = os.stat(source)
+    except OSError:
+        return []
+    if not stat.S_ISBLK(st.st_mode):
+        return []
+    disk = whole_disk(st.st_rdev)
+    if disk is None:
+        return []
+    if fstype == 'btrfs':
+        #Members are listed as partitions, so resolve each to its disk
+        source_dir = os.path.realpath(f'/sys/dev/block/{os.major(st.st_rdev)}:{os.minor(st.st_rdev)}')
+        disks = []
+        for member in _btrfs_members(source_dir):
+            if os.path.exists(os.path.join(member, 'partition')):
+                member = os.path.dirname(member)
+            if member not in disks:
+                disks.append(member)
+        return sorted(disks)
+    return [disk]
+
+def is_rotational(disk):
+    '''
+    Checks whether a disk (as returned by whole_disk) is a spinning disk.
+    Disks whose type cannot be determined, including None, are treated as
+    rotational, to avoid thrashing them.
+    '''
+    if disk is None:
+        return True
+    try:
+        with open(os.path.join(disk, 'queue', 'rotational')) as f:
+            return f.read().strip() == '1'
+    except OSError:
+        return True
+
+class HashScheduler:
+    '''
+    Hashes File objects in an order suited to the underlying storage.
+
+    Parameters
+    ----------
+    hdd_workers : int, optional
+        Concurrent hashes per rotational or unidentified disk.
+        The default is 1.
+    ssd_workers : int, optional
+        Concurrent hashes per non-rotational disk. The default is
+        os.cpu_count().
+    buffersize : int, optional
+        Read buffer size, in bytes. The default is 2**22.
+    use_extents : bool, optional
+        Order files by physical extent where available, rather than inode.
+        The default is True.
+    algorithm : str, optional
+        Hash algorithm passed to File.gethash. The default is 'sha256'.
+    device_workers : dict, optional
+        Concurrent hashes for specific disks, keyed by any path on the disk
+        (e.g. a mount point). Overrides the defaults above, for instance to
+        run an SSD-backed network share wide. The default is None.
+    '''
+
+    def __init__(self, hdd_workers=1, ssd_workers=None, buffersize=2**22,
+                 use_extents=True, algorithm='sha256', device_workers=None):
+        self.hdd_workers = hdd_workers
+        self.ssd_workers = ssd_workers or os.cpu_count() or 1
+        self.buffersize = buffersize
+        self.use_extents = use_extents
+        self.algorithm = algorithm
+        self._disks = {}
+        self._rotational = {}
+        self._overrides = {}
+        for path, workers in (device_workers or {}).items():
+            self._overrides[self.disk(os.stat(path).st_dev, path)] = workers
+        return
+
+    def disk(self, device, path=None):
+        '''
+        Returns the key used to group a device: its whole disk where one can
+        be identified, a tuple of disks for filesystems spanning several (see
+        backing_disks), otherwise the device itself.
+        '''
+        if device not in self._disks:
+            disks = backing_disks(device, path)
+            if len(disks) == 1:
+                self._disks[device] = disks[0]
+            elif disks:
+                self._disks[device] = tuple(disks)
+            else:
+                self._disks[device] = device
+        return self._disks[device]
+
+    def rotational(self, disk, path=None):
+        '''
+        Checks whether a disk (as returned by disk) should be read one file
+        at a time. Filesystems spanning several disks count as rotational if
+        any of them is; unidentified devices are rotational unless they are
+        held in memory.
+        '''
+        if disk not in self._rotational:
+            if type(disk) is str:
+                rotational = is_rotational(disk)
+            elif type(disk) is tuple:
+                rotational = any(is_rotational(member) for member in disk)
+            else:
+                mount = mount_info(disk, path)
+                rotational = mount is None or mount[0] not in _MEMORY_FS
+            self._rotational[disk] = rotational
+        return self._rotational[disk]
+
+    def workers(self, disk):
+        if disk in self._overrides:
+            return self._overrides[disk]
+        if self.rotational(disk):
+            return self.hdd_workers
+        return self.ssd_workers
+
+    def plan(self, files):
+        '''
+        Groups files by disk and sorts each group into read order.
+
+        Parameters
+        ----------
+        files : iterable
+            File objects to be hashed.
+
+        Returns
+        -------
+        plan : dict
+            Dictionary mapping disk (see disk) to list of File objects, in
+            the order they should be read.
+        '''
+        groups = {}
+        for file in files:
+            try:
+                st = os.stat(file.long_name)
+            except OSError:
+                print(f'WARNING:File {file.long_name} could not be found!', file=sys.stderr)
+                continue
+            disk = self.disk(st.st_dev, file.long_name)
+            #Inode numbers are per filesystem, so keep partitions apart
+            key = (1, st.st_dev, st.st_ino)
+            if self.use_extents and self.rotational(disk, file.long_name):
+                offset = physical_offset(file.long_name)
+                if offset is not None:
+                    key = (0, st.st_dev, offset)
+            groups.setdefault(disk, []).append((key, file))
+
+        plan = {}
+        for disk, keyed in groups.items():
+            keyed.sort(key=lambda pair: pair[0])
+            plan[disk] = [file for key, file in keyed]
+        return plan
+
+    def _hash(self, file):
+        try:
+            file.gethash(self.buffersize, advise=True, algorithm=self.algorithm)
+        except OSError:
+            print(f'WARNING:File {file.long_name} could not be hashed!', file=sys.stderr)
+        return file
+
+    def run(self, files):
+        '''
+        Hashes files, yielding each File object once its hash is set.
+        Disks are processed concurrently; within a disk, files are
+        submitted in read order and the pool size limits concurrency.
+
+        Parameters
+        ----------
+        files : iterable
+            File objects to be hashed.
+
+        Yields
+        ------
+        file : File
+            File object, with hash attribute set (or None if reading failed).
+        '''
+        plan = self.plan(files)
+        executors = []
+        futures = []
+        try:
+            for disk, ordered in plan.items():
+                executor = ThreadPoolExecutor(max_workers=self.workers(disk))
+                executors.append(executor)
+                for file in ordered:
+                    futures.append(executor.submit(self._hash, file))
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            for executor in executors:
+                executor.shutdown(cancel_futures=True)
+        return
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+Versioned catalog snapshots.
+
+A SnapshotStore is a directory holding a gzip-compressed base catalog
+followed by compressed deltas, each listing the files added, removed and
+modified since the previous snapshot, with a fresh base every few
+snapshots. Any snapshot can be rebuilt by replaying deltas onto the
+nearest earlier base, and growth or per-file history queries are answered
+from the deltas without building FileTrees.
+
+Layout::
+
+    manifest.json           snapshot list with timestamps and totals
+    000000.base.json.gz     full record list
+    000001.delta.json.gz    {'added': [...], 'removed': [...], 'modified': [...]}
+"""
+
+import os, json, gzip, time
+from .core import FileTree
+
+#Record fields compared between snapshots. Access times change on every read
+#and are deliberately ignored. A newly computed hash counts as a change, so
+#the store can rebuild exactly the records it was given.
+_COMPARED = ('size', 'modified', 'hash', 'tags')
+
+def _changed(old, new):
+    return any(old[key] != new[key] for key in _COMPARED)
+
+def diff_records(old, new):
+    '''
+    Computes the delta between two record dictionaries.
+
+    Parameters
+    ----------
+    old : dict
+        Dictionary mapping absolute path to file metadata dictionary.
+    new : dict
+        Dictionary mapping absolute path to file metadata dictionary.
+
+    Returns
+    -------
+    delta : dict
+        Dictionary with 'added' (new records), 'removed' (old records) and
+        'modified' ([old record, new record] pairs) lists.
+    '''
+    delta = {'added':[], 'removed':[], 'modified':[]}
+    for path, record in new.items():
+        previous = old.get(path)
+        if previous is None:
+            delta['added'].append(record)
+        elif _changed(previous, record):
+            delta['modified'].append([previous, record])
+    for path, record in old.items():
+        if path not in new:
+            delta['removed'].append(record)
+    return delta
+
+def apply_delta(records, delta):
+    '''
+    Applies a delta to a record dictionary, in place.
+    '''
+    for record in delta['removed']:
+        records.pop(record['fullname'], None)
+    for record in delta['added']:
+        records[record['fullname']] = record
+    for previous, record in delta['modified']:
+        records[record['fullname']] = record
+    return records
+
+def _under(path, prefix):
+    return prefix is None or path == prefix or path.startswith(prefix.rstrip(os.sep) + os.sep)
+
+class SnapshotStore:
+    '''
+    Directory of catalog snapshots stored as a base plus deltas.
+
+    Parameters
+    ----------
+    path : str
+        Directory holding the store. Created if it does not exist.
+    rebase_every : int, optional
+        Write a fresh base after this many consecutive deltas, bounding the
+        replay cost of rebuilding a snapshot. None never rebases.
+        The default is 30.
+    '''
+
+    def __init__(self, path, rebase_every=30):
+        self.path = os.path.abspath(path)
+        self.rebase_every = rebase_every
+        self._latest = None         #Records of the latest snapshot, once known
+        os.makedirs(self.path, exist_ok=True)
+        self._manifest_path = os.path.join(self.path, 'manifest.json')
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'root':None, 'snapshots':[]}
+        return
+
+    def __len__(self):
+        return len(self.manifest['snapshots'])
+
+    @property
+    def root(self):
+        return self.manifest['root']
+
+    @property
+    def snapshots(self):
+        return self.manifest['snapshots']
+
+    def _read(self, name):
+        with gzip.open(os.path.join(self.path, name), 'rt') as f:
+            return json.load(f)
+
+    def _write(self, name, data):
+        with gzip.open(os.path.join(self.path, name), 'wt') as f:
+            json.dump(data, f)
+        return
+
+    def _save_manifest(self):
+        tmp = self._manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp, self._manifest_path)
+        return
+
+    def _index(self, index):
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError(f'Snapshot {index} not in store of {n} snapshots')
+        return index
+
+    def _stream(self):
+        #Yields (index, entry, data) for each snapshot, reading one file at a time
+        for index, entry in enumerate(self.snapshots):
+            yield index, entry, self._read(entry['file'])
+        return
+
+    def records(self, index=-1):
+        '''
+        Rebuilds the file records of a snapshot, starting from the nearest
+        base at or before it.
+
+        Parameters
+        ----------
+        index : int, optional
+            Snapshot number; negative values count from the latest.
+            The default is -1.
+
+        Returns
+        -------
+        records : dict
+            Dictionary mapping absolute path to file metadata dictionary.
+        '''
+        index = self._index(index)
+        start = index
+        while self.snapshots[start]['kind'] != 'base':
+            start -= 1
+        records = {}
+        for i in range(start, index + 1):
+            data = self._read(self.snapshots[i]['file'])
+            if i == start:
+                records = {record['fullname']:record for record in data}
+            else:
+                apply_delta(records, data)
+        return records
+
+    def checkout(self, index=-1):
+        '''
+        Rebuilds the FileTree of a snapshot. See records.
+        '''
+        return FileTree.from_records(self.root, self.records(index).values())
+
+    def commit(self, filetree, timestamp=None):
+        '''
+        Adds a snapshot of a filetree to the store. The first snapshot, and
+        every rebase_every-th after it, is stored in full; others are
+        stored as a delta against the previous snapshot. The records just
+        committed are kept, so successive commits do not replay the chain.
+
+        Parameters
+        ----------
+        filetree : FileTree
+            Filetree to be recorded. Must have the same root as earlier
+            snapshots.
+        timestamp : float, optional
+            Time of the snapshot, in seconds since the epoch.
+            The default is the current time.
+
+        Returns
+        -------
+        index : int
+            Number of the new snapshot.
+        '''
+        if self.root is None:
+            self.manifest['root'] = filetree.root
+        elif filetree.root != self.root:
+            raise ValueError(f'Store holds snapshots of {self.root}, not {filetree.root}')
+        if timestamp is None:
+            timestamp = time.time()
+
+        new = {file.long_name:file.decompose() for file in filetree.iterfiles()}
+        index = len(self)
+        since_base = 0
+        for entry in reversed(self.snapshots):
+            if entry['kind'] == 'base':
+                break
+            since_base += 1
+        rebase = index == 0 or (self.rebase_every is not None
+                                and since_base >= self.rebase_every)
+
+        entry = {'index':index, 'time':timestamp, 'size':filetree.size,
+                 'files':filetree.n_files}
+        if rebase:
+            entry['kind'] = 'base'
+            entry['file'] = f'{index:06d}.base.json.gz'
+            self._write(entry['file'], list(new.values()))
+        else:
+            if self._latest is None:
+                self._latest = self.records()
+            delta = diff_records(self._latest, new)
+            entry['kind'] = 'delta'
+            entry['file'] = f'{index:06d}.delta.json.gz'
+            for key, changes in delta.items():
+                entry[key] = len(changes)
+            self._write(entry['file'], delta)
+
+        self.snapshots.append(entry)
+        self._save_manifest()
+        self._latest = new
+        return index
+
+    def history(self, fullname):
+        '''
+        Lists the snapshots in which a file appeared, changed or vanished.
+        Deltas are scanned for the path; bases are only consulted to find
+        its state when a chain starts.
+
+        Parameters
+        ----------
+        fullname : str
+            Absolute path of file.
+
+        Returns
+        -------
+        events : list
+            List of (snapshot index, timestamp, status, record) tuples, where
+            status is 'added', 'modified' or 'removed'.
+        '''
+        events = []
+        current = None
+        for index, entry, data in self._stream():
+            record = None
+            status = None
+            if entry['kind'] == 'base':
+                record = next((r for r in data if r['fullname'] == fullname), None)
+                if current is None and record is not None:
+                    status = 'added'
+                elif current is not None and record is None:
+                    status, record = 'removed', current
+                elif current is not None and _changed(current, record):
+                    status = 'modified'
+                current = record if status != 'removed' else None
+            else:
+                for r in data['added']:
+                    if r['fullname'] == fullname:
+                        status, record, current = 'added', r, r
+                for r in data['removed']:
+                    if r['fullname'] == fullname:
+                        status, record, current = 'removed', r, None
+                for previous, r in data['modified']:
+                    if r['fullname'] == fullname:
+                        status, record, current = 'modified', r, r
+            if status is not None:
+                events.append((index, entry['time'], status, record))
+        return events
+
+    def growth(self, prefix=None):
+        '''
+        Reports total size and file count at every snapshot.
+
+        Parameters
+        ----------
+        prefix : str, optional
+            Only count files below this directory. Without a prefix, totals
+            are read from the manifest; with one, they are accumulated from
+            the bases and deltas. The default is None.
+
+        Returns
+        -------
+        growth : list
+            List of (snapshot index, timestamp, size, file count) tuples.
+        '''
+        if prefix is None:
+            return [(entry['index'], entry['time'], entry['size'], entry['files'])
+                    for entry in self.snapshots]
+
+        growth = []
+        size = 0
+        count = 0
+        for index, entry, data in self._stream():
+            if entry['kind'] == 'base':
+                matching = [r for r in data if _under(r['fullname'], prefix)]
+                size = sum(r['size'] or 0 for r in matching)
+                count = len(matching)
+            else:
+                for r in data['added']:
+                    if _under(r['fullname'], prefix):
+                        size += r['size'] or 0
+                        count += 1
+                for r in data['removed']:
+                    if _under(r['fullname'], prefix):
+                        size -= r['size'] or 0
+                        count -= 1
+                for previous, r in data['modified']:
+                    if _under(r['fullname'], prefix):
+                        size += (r['size'] or 0) - (previous['size'] or 0)
+            growth.append((index, entry['time'], size, count))
+        return growth